@@ -24,10 +24,12 @@ import asyncio
 import logging
 import signal
 import sys
+import time
 from pathlib import PurePosixPath
-from typing import Any
+from typing import Any, Callable
 
 import gmqtt
+import orjson
 import yaml
 from bme280 import BME280
 from getmac import get_mac_address
@@ -37,13 +39,15 @@ from typing_extensions import TypeAlias
 from .data import (
     DEFAULT_SENSORS,
     PMS5003_SENSORS,
+    SampleBuffer,
     check_wifi,
     get_current_data,
+    get_current_data_with_pms5003,
     get_serial_number,
     setup_pms5003,
     setup_sensors,
 )
-from .mqtt import MQTTConf, get_mqtt_client, setup_mqtt_config
+from .mqtt import MQTTConf, get_mqtt_client, on_connect, setup_mqtt_config
 
 log = logging.getLogger(__name__)
 
@@ -51,6 +55,10 @@ log = logging.getLogger(__name__)
 # TODO: Should be higher but I'm impatient during testing
 # WARMUP_TIME = timedelta(minutes=2).total_seconds()
 WARMUP_TIME = 10
+# How much extra time to leave between readings when something keeps failing
+MAX_ERROR_BACKOFF = 30
+# How many batches' worth of readings to hold on to while the broker is away
+MAX_PENDING_BATCHES = 10
 
 
 def _load_config() -> dict[str, Any]:
@@ -58,6 +66,17 @@ def _load_config() -> dict[str, Any]:
         return yaml.safe_load(f)  # type: ignore
 
 
+def _install_uvloop() -> None:
+    # uvloop is optional, but it's much lighter than the stock event loop
+    try:
+        import uvloop
+    except ImportError:
+        return
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    log.info("Using uvloop")
+
+
 def main() -> None:
     logging.basicConfig(
         level=logging.INFO,
@@ -65,9 +84,7 @@ def main() -> None:
         format="%(asctime)s %(name)-16s %(levelname)-8s %(message)s",
         datefmt="%H:%M:%S",
     )
-    STOP = asyncio.Event()
-
-    loop = asyncio.get_event_loop()
+    _install_uvloop()
 
     # Raspberry Pi ID
     device_serial_number = get_serial_number()
@@ -92,44 +109,29 @@ def main() -> None:
     )
 
     # Display Raspberry Pi serial and Wi-Fi status
-    print("RPi serial: {}".format(device_serial_number))
-    print("Wi-Fi: {}\n".format("connected" if check_wifi() else "disconnected"))
-    print("MQTT broker IP: {}".format(mqtt_conf["broker"]))
-
-    main_task = loop.create_task(_main(loop, mqtt_conf, device_serial_number))
-
-    def _stop(*args: Any) -> None:
-        log.error("Interrupt!")
-        if STOP.is_set():
-            log.critical("Killed!")
-            sys.exit(1)
-        STOP.set()
-        main_task.cancel()
-
-    loop.add_signal_handler(signal.SIGINT, _stop)
-    loop.add_signal_handler(signal.SIGTERM, _stop)
+    wifi_status = "connected" if check_wifi() else "disconnected"
+    print(f"RPi serial: {device_serial_number}")
+    print(f"Wi-Fi: {wifi_status}\n")
+    print(f"MQTT broker IP: {mqtt_conf['broker']}")
 
     try:
-        loop.run_until_complete(main_task)
+        asyncio.run(_main(mqtt_conf, device_serial_number))
     except (asyncio.CancelledError, asyncio.TimeoutError):
         pass
 
-    loop.stop()
-
 
 # It'd probably make my life easier to type these but I'm lazy
 HADiscoveryDevice: TypeAlias = dict[str, Any]
 HADiscoveryPacket: TypeAlias = dict[str, Any]
 
 
-def _do_discovery(
+def _build_discovery(
     mqtt_conf: MQTTConf,
-    mqtt_client: gmqtt.Client,
     serial: str,
     has_pms5003: bool,
-) -> None:
+) -> dict[str, bytes]:
     if not mqtt_conf["discovery"]:
-        return
+        return {}
 
     data: HADiscoveryPacket
     device: HADiscoveryDevice | None = None
@@ -148,51 +150,64 @@ def _do_discovery(
     config_topic = PurePosixPath(mqtt_conf["discovery_prefix"], "sensor")
     state_topic = str(PurePosixPath(mqtt_conf["topic_prefix"], serial))
 
-    log.info("Publishing HA discovery to %s", config_topic)
+    per_metric_topics = mqtt_conf["per_metric_topics"]
 
-    for name, sensor in DEFAULT_SENSORS.items():
+    sensors = list(DEFAULT_SENSORS.items())
+    if has_pms5003:
+        sensors += PMS5003_SENSORS.items()
+
+    # None of this changes after startup, so serialise it all up front
+    discovery: dict[str, bytes] = {}
+    for name, sensor in sensors:
         data = {
-            **sensor,
+            **sensor.as_discovery(state_topic, per_metric_topics),
             "uniq_id": serial + "_" + name,
-            "stat_t": state_topic,
         }
         if device:
             data["dev"] = device
 
-        mqtt_client.publish(
-            str(config_topic / data["uniq_id"] / "config"),
-            data,
-            qos=1,
-            retain=mqtt_conf["discovery_retain"],
-            content_type="application/json",
-        )
+        discovery[str(config_topic / data["uniq_id"] / "config")] = orjson.dumps(data)
+
+    return discovery
+
 
-    if not has_pms5003:
+def _do_discovery(
+    mqtt_conf: MQTTConf,
+    mqtt_client: gmqtt.Client,
+    discovery: dict[str, bytes],
+) -> None:
+    if not discovery:
         return
 
-    for name, sensor in PMS5003_SENSORS.items():
-        data = {
-            **sensor,
-            "uniq_id": serial + "_" + name,
-            "stat_t": state_topic,
-        }
-        if device:
-            data["dev"] = device
+    log.info("Publishing HA discovery for %d sensors", len(discovery))
 
+    for topic, payload in discovery.items():
         mqtt_client.publish(
-            str(config_topic / data["uniq_id"] / "config"),
-            data,
+            topic,
+            payload,
             qos=1,
             retain=mqtt_conf["discovery_retain"],
             content_type="application/json",
         )
 
 
-async def _main(
-    loop: asyncio.AbstractEventLoop,
-    mqtt_conf: MQTTConf,
-    serial: str,
-) -> None:
+async def _main(mqtt_conf: MQTTConf, serial: str) -> None:
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    assert main_task is not None
+    stop = asyncio.Event()
+
+    def _stop(*args: Any) -> None:
+        log.error("Interrupt!")
+        if stop.is_set():
+            log.critical("Killed!")
+            sys.exit(1)
+        stop.set()
+        main_task.cancel()
+
+    loop.add_signal_handler(signal.SIGINT, _stop)
+    loop.add_signal_handler(signal.SIGTERM, _stop)
+
     client_t = loop.create_task(get_mqtt_client(mqtt_conf))
     pms5003_setup_t = loop.create_task(setup_pms5003(loop))
 
@@ -209,21 +224,29 @@ async def _main(
         return_when=asyncio.FIRST_EXCEPTION,
     )
 
-    if client_t.done():
-        mqtt_client = await client_t
-    else:
+    if not client_t.done():
         logging.info("Sensors are warm, waiting for MQTT client to connect")
-        # TODO: Remove timeout, for production we want this to wait indefinitely
-        # in case the MQTT server is taking a while to start
-        try:
-            mqtt_client = await asyncio.wait_for(client_t, timeout=10)
-        except asyncio.TimeoutError:
-            log.exception("Timed out waiting for the MQTT client to connect")
-            raise
+    mqtt_client = await client_t
 
-    _do_discovery(mqtt_conf, mqtt_client, serial, pms5003_t is not None)
+    discovery = _build_discovery(mqtt_conf, serial, pms5003_t is not None)
+    _do_discovery(mqtt_conf, mqtt_client, discovery)
+
+    # If the broker restarted it may well have forgotten about us, so send the
+    # discovery configs again whenever we reconnect
+    def _on_connect(
+        client: gmqtt.Client,
+        flags: int,
+        rc: int,
+        properties: dict[Any, Any],
+    ) -> None:
+        on_connect(client, flags, rc, properties)
+        _do_discovery(mqtt_conf, client, discovery)
+
+    mqtt_client.on_connect = _on_connect
+
+    # Whether the PMS5003 is there won't change, so don't check every tick
+    read_data = get_current_data_with_pms5003 if pms5003_t else get_current_data
 
-    mqtt_client = await client_t
     logging.info("Sensors are warm, going live")
 
     try:
@@ -233,8 +256,10 @@ async def _main(
             mqtt_client,
             bme280,
             ltr559,
+            read_data,
+            stop,
         )
-    except asyncio.CancelledError:
+    finally:
         if pms5003_t:
             pms5003_t.cancel()
         try:
@@ -243,32 +268,107 @@ async def _main(
             log.error("Timed out trying to disconnect")
 
 
+def _next_backoff(backoff: int) -> int:
+    return min(backoff * 2 or 1, MAX_ERROR_BACKOFF)
+
+
 async def _main_loop(
     mqtt_conf: MQTTConf,
     serial: str,
     mqtt_client: gmqtt.Client,
     bme280: BME280,
     ltr559: LTR559,
+    read_data: Callable[[LTR559, BME280], dict[str, Any]],
+    stop: asyncio.Event,
 ) -> None:
     log.info("It's looping time")
+    loop = asyncio.get_running_loop()
     topic = mqtt_conf["topic_prefix"] + "/" + serial
 
+    # None of these change while we're running, so only look them up once
+    qos = mqtt_conf["qos"]
+    retain = mqtt_conf["retain"]
+    interval = mqtt_conf["publish_interval"]
+    batch_size = mqtt_conf["batch_size"]
+    per_metric_topics = mqtt_conf["per_metric_topics"]
+    publish = mqtt_client.publish
+    batch = SampleBuffer(batch_size * MAX_PENDING_BATCHES)
+
+    def _publish(payload: dict[str, Any]) -> None:
+        if per_metric_topics:
+            # Each reading (or column of batched readings) gets its own topic
+            for key, value in payload.items():
+                publish(
+                    topic + "/" + key,
+                    orjson.dumps(value),
+                    qos=qos,
+                    retain=retain,
+                    content_type="application/json",
+                )
+            return
+
+        publish(
+            topic,
+            # Serialise it ourselves as orjson is much faster than gmqtt's json
+            orjson.dumps(payload),
+            qos=qos,
+            retain=retain,
+            content_type="application/json",
+        )
+
+    backoff = 0
+
     # Main loop to read data, display, and send over mqtt
-    while True:
-        try:
-            values = get_current_data(ltr559, bme280)
-            mqtt_client.publish(
-                topic,
-                values,
-                qos=mqtt_conf["qos"],
-                retain=mqtt_conf["retain"],
-                content_type="application/json",
+    try:
+        while not stop.is_set():
+            try:
+                # Talking to the sensors blocks, so keep it off the event loop
+                values = await loop.run_in_executor(None, read_data, ltr559, bme280)
+            except Exception:
+                # CancelledError isn't an Exception, so shutting down still
+                # works. Anything else is logged and retried: exiting would
+                # mean waiting for the sensors to warm up all over again
+                log.exception("Error reading from the sensors")
+                backoff = _next_backoff(backoff)
+            else:
+                if batch_size > 1:
+                    values["ts"] = time.time()
+                    batch.append(values)
+                try:
+                    if not mqtt_client.is_connected:
+                        # gmqtt reconnects by itself, so just hold on to any
+                        # batched readings until it's back
+                        log.warning("Not connected to the broker, skipping publish")
+                    elif batch_size == 1:
+                        _publish(values)
+                    elif len(batch) >= batch_size:
+                        _publish(batch.as_dict())
+                        batch.clear()
+                except Exception:
+                    log.exception("Error publishing data")
+                    backoff = _next_backoff(backoff)
+                else:
+                    backoff = 0
+
+            if backoff:
+                log.warning("Waiting an extra %d seconds after an error", backoff)
+
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=interval + backoff)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # Don't throw away any readings we've been sitting on
+        if batch and not mqtt_client.is_connected:
+            # gmqtt would quietly drop them on the floor, so at least say so
+            log.warning(
+                "Not connected to the broker, dropping %d unsent readings", len(batch)
             )
-            await asyncio.sleep(mqtt_conf["publish_interval"])
-        except asyncio.CancelledError:
-            raise
-        except Exception:
-            log.exception("Error getting data")
+        elif batch:
+            try:
+                _publish(batch.as_dict())
+            except Exception:
+                log.exception("Error publishing the remaining readings")
 
 
 main()
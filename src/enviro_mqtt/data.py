@@ -16,19 +16,23 @@
 from __future__ import annotations
 
 import asyncio
+import functools
 import logging
+import math
+import os
+import struct
 import subprocess
-from typing import Any, Optional
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Any, NamedTuple, Optional, cast
 
 from bme280 import BME280
 from enviroplus import gas
 from ltr559 import LTR559
-from pms5003 import (
-    PMS5003,
-    ChecksumMismatchError as PMS5003ChecksumError,
-    ReadTimeoutError as PMS5003ReadTimeoutError,
-    SerialTimeoutError as PMS5003SerialTimeoutError,
-)
+from pms5003 import PMS5003
 from typing_extensions import TypedDict
 
 log = logging.getLogger(__name__)
@@ -58,97 +62,123 @@ class GasResult(TypedDict):
     nh3: float
 
 
-DEFAULT_SENSORS = {
-    "lux": {
-        "dev_cla": "illuminance",
-        "name": "Brightness",
-        "unit_of_meas": "lx",
-        "val_tpl": "{{ value_json.lux }}",
-    },
-    "temp": {
-        "dev_cla": "temperature",
-        "name": "Temperature",
-        "unit_of_meas": "°C",
-        "val_tpl": "{{ value_json.temperature }}",
-    },
-    "humidity": {
-        "dev_cla": "humidity",
-        "name": "Humidity",
-        "unit_of_meas": "%",
-        "val_tpl": "{{ value_json.humidity }}",
-    },
-    "pressure": {
-        "dev_cla": "pressure",
-        "name": "Pressure",
-        "unit_of_meas": "hPa",
-        "val_tpl": "{{ value_json.pressure }}",
-    },
-    "oxidising": {
-        "name": "Oxidising Gas",
-        "unit_of_meas": "kΩ",
-        "val_tpl": "{{ value_json.oxidising }}",
-    },
-    "reducing": {
-        "name": "Reducing Gas",
-        "unit_of_meas": "kΩ",
-        "val_tpl": "{{ value_json.reducing }}",
-    },
-    "nh3": {
-        "name": "Ammonia Gas",
-        "unit_of_meas": "kΩ",
-        "val_tpl": "{{ value_json.nh3 }}",
-    },
-}
-PMS5003_SENSORS = {
-    "pm1": {
-        "dev_cla": "pm1",
-        "name": "PM1",
-        "unit_of_meas": "µg/m³",
-        "val_tpl": "{{ value_json.pm1 }}",
-    },
-    "pm25": {
-        "dev_cla": "pm25",
-        "name": "PM2.5",
-        "unit_of_meas": "µg/m³",
-        "val_tpl": "{{ value_json.pm25 }}",
-    },
-    "pm10": {
-        "dev_cla": "pm10",
-        "name": "PM10",
-        "unit_of_meas": "µg/m³",
-        "val_tpl": "{{ value_json.pm10 }}",
-    },
-    "pl03": {
-        "name": "Particles >0.3um",
-        "unit_of_meas": "#/0.1L",
-        "val_tpl": "{{ value_json.pl03 }}",
-    },
-    "pl05": {
-        "name": "Particles >0.5um",
-        "unit_of_meas": "#/0.1L",
-        "val_tpl": "{{ value_json.pl05 }}",
-    },
-    "pl1": {
-        "name": "Particles >1um",
-        "unit_of_meas": "#/0.1L",
-        "val_tpl": "{{ value_json.pl1 }}",
-    },
-    "pl25": {
-        "name": "Particles >2.5um",
-        "unit_of_meas": "#/0.1L",
-        "val_tpl": "{{ value_json.pl25 }}",
-    },
-    "pl5": {
-        "name": "Particles >5um",
-        "unit_of_meas": "#/0.1L",
-        "val_tpl": "{{ value_json.pl5 }}",
-    },
-    "pl10": {
-        "name": "Particles >10um",
-        "unit_of_meas": "#/0.1L",
-        "val_tpl": "{{ value_json.pl10 }}",
-    },
-}
+class SensorMeta(NamedTuple):
+    name: str
+    unit_of_meas: str
+    # Which of the readings from get_current_data this sensor reports
+    value_key: str
+    dev_cla: Optional[str] = None
+
+    def as_discovery(self, state_topic: str, per_metric_topics: bool) -> dict[str, str]:
+        data = {"name": self.name, "unit_of_meas": self.unit_of_meas}
+        if self.dev_cla is not None:
+            data["dev_cla"] = self.dev_cla
+
+        if per_metric_topics:
+            # The payload is just the value, so HA doesn't need a template
+            data["stat_t"] = state_topic + "/" + self.value_key
+        else:
+            data["stat_t"] = state_topic
+            data["val_tpl"] = "{{ value_json." + self.value_key + " }}"
+
+        return data
+
+
+DEFAULT_SENSORS = MappingProxyType(
+    {
+        "lux": SensorMeta(
+            dev_cla="illuminance",
+            name="Brightness",
+            unit_of_meas="lx",
+            value_key="lux",
+        ),
+        "temp": SensorMeta(
+            dev_cla="temperature",
+            name="Temperature",
+            unit_of_meas="°C",
+            value_key="temperature",
+        ),
+        "humidity": SensorMeta(
+            dev_cla="humidity",
+            name="Humidity",
+            unit_of_meas="%",
+            value_key="humidity",
+        ),
+        "pressure": SensorMeta(
+            dev_cla="pressure",
+            name="Pressure",
+            unit_of_meas="hPa",
+            value_key="pressure",
+        ),
+        "oxidising": SensorMeta(
+            name="Oxidising Gas",
+            unit_of_meas="kΩ",
+            value_key="oxidising",
+        ),
+        "reducing": SensorMeta(
+            name="Reducing Gas",
+            unit_of_meas="kΩ",
+            value_key="reducing",
+        ),
+        "nh3": SensorMeta(
+            name="Ammonia Gas",
+            unit_of_meas="kΩ",
+            value_key="nh3",
+        ),
+    }
+)
+PMS5003_SENSORS = MappingProxyType(
+    {
+        "pm1": SensorMeta(
+            dev_cla="pm1",
+            name="PM1",
+            unit_of_meas="µg/m³",
+            value_key="pm1",
+        ),
+        "pm25": SensorMeta(
+            dev_cla="pm25",
+            name="PM2.5",
+            unit_of_meas="µg/m³",
+            value_key="pm25",
+        ),
+        "pm10": SensorMeta(
+            dev_cla="pm10",
+            name="PM10",
+            unit_of_meas="µg/m³",
+            value_key="pm10",
+        ),
+        "pl03": SensorMeta(
+            name="Particles >0.3um",
+            unit_of_meas="#/0.1L",
+            value_key="pl03",
+        ),
+        "pl05": SensorMeta(
+            name="Particles >0.5um",
+            unit_of_meas="#/0.1L",
+            value_key="pl05",
+        ),
+        "pl1": SensorMeta(
+            name="Particles >1um",
+            unit_of_meas="#/0.1L",
+            value_key="pl1",
+        ),
+        "pl25": SensorMeta(
+            name="Particles >2.5um",
+            unit_of_meas="#/0.1L",
+            value_key="pl25",
+        ),
+        "pl5": SensorMeta(
+            name="Particles >5um",
+            unit_of_meas="#/0.1L",
+            value_key="pl5",
+        ),
+        "pl10": SensorMeta(
+            name="Particles >10um",
+            unit_of_meas="#/0.1L",
+            value_key="pl10",
+        ),
+    }
+)
 
 
 def setup_sensors() -> tuple[BME280, LTR559]:
@@ -170,16 +200,51 @@ def read_ltr559(ltr559: LTR559) -> float:
     return round(lux, 2)
 
 
-# Get CPU temperature to use for compensation
-def get_cpu_temperature() -> float:
+CPU_TEMPERATURE_PATH = "/sys/class/thermal/thermal_zone0/temp"
+# The CPU temperature changes slowly, so there's no point reading it every tick
+CPU_TEMPERATURE_CACHE_TIME = 30
+
+_cpu_temp_fd: Optional[int] = None
+_cpu_temp_cache: Optional[tuple[float, float]] = None
+
+
+def _read_vcgencmd_temperature() -> float:
+    # Don't use check=True: a failing vcgencmd is just a bad reading for this
+    # tick (the float() below will complain), not a reason to stop
     result = subprocess.run(
         ["vcgencmd", "measure_temp"],
         capture_output=True,
         text=True,
-        encoding="UTF-8",
     )
-    output = result.stdout
-    return float(output[output.index("=") + 1 : output.rindex("'")])
+    # On success this always prints exactly "temp=NN.N'C\n"
+    return float(result.stdout[5:-3])
+
+
+def _read_cpu_temperature() -> float:
+    global _cpu_temp_fd
+    # sysfs files can be re-read from the start without reopening them
+    if _cpu_temp_fd is None:
+        try:
+            _cpu_temp_fd = os.open(CPU_TEMPERATURE_PATH, os.O_RDONLY)
+        except FileNotFoundError:
+            # Not every kernel has a thermal zone, so ask the firmware instead
+            return _read_vcgencmd_temperature()
+    # The kernel reports millidegrees
+    return int(os.pread(_cpu_temp_fd, 16, 0)) / 1000.0
+
+
+# Get CPU temperature to use for compensation
+def get_cpu_temperature() -> float:
+    global _cpu_temp_cache
+    now = time.monotonic()
+    if _cpu_temp_cache is not None:
+        read_at, cpu_temp = _cpu_temp_cache
+        if now - read_at < CPU_TEMPERATURE_CACHE_TIME:
+            return cpu_temp
+
+    cpu_temp = _read_cpu_temperature()
+    _cpu_temp_cache = (now, cpu_temp)
+    return cpu_temp
 
 
 # Read values from BME280 and return as dict
@@ -187,17 +252,31 @@ def read_bme280(bme280: BME280) -> BME280Result:
     # Compensation factor for temperature
     comp_factor = 2.25
     cpu_temp = get_cpu_temperature()
-    raw_temp = bme280.get_temperature()  # float
+    # Each of the get_* methods does a full update, so do a single update (which
+    # reads all three values in one block) and use the results directly
+    bme280.update_sensor()
+    raw_temp: float = bme280.temperature
     comp_temp = raw_temp - ((cpu_temp - raw_temp) / comp_factor)
     return {
         "temperature": round(comp_temp, 2),
-        "pressure": round(bme280.get_pressure(), 2),
-        "humidity": round(bme280.get_humidity(), 1),
+        "pressure": round(bme280.pressure, 2),
+        "humidity": round(bme280.humidity, 1),
     }
 
 
+# Readings that are shared between everything run during a single tick
+_tick_cache: dict[str, Any] = {}
+
+
+def _read_gas_all() -> Any:
+    # Only talk to the MICS6814 once per tick no matter how many readers want it
+    if "gas" not in _tick_cache:
+        _tick_cache["gas"] = gas.read_all()
+    return _tick_cache["gas"]
+
+
 def read_gas() -> GasResult:
-    data = gas.read_all()
+    data = _read_gas_all()
     return {
         "oxidising": round(data.oxidising / 1000, 4),
         "reducing": round(data.reducing / 1000, 4),
@@ -205,86 +284,244 @@ def read_gas() -> GasResult:
     }
 
 
-_pms5003_data: Optional[PMS5003Result] = None
+PMS5003_SOF = b"BM"
+PMS5003_FRAME_SIZE = 32
+# The sensor sends a frame roughly every second, so this means it's gone quiet
+PMS5003_TIMEOUT = 5
+
+# Single slot rather than a global so the reader callbacks don't need `global`
+_pms5003_data: list[Optional[PMS5003Result]] = [None]
+
+
+# Start of frame, frame length, 13 data words and then a checksum
+_PMS5003_FRAME = struct.Struct(">2s15H")
+# The standard particulate concentrations are the first three data words
+_PMS5003_PM_KEYS = ("pm1", "pm25", "pm10")
+# And the particle counts per 0.1L of air are the 7th to 12th
+_PMS5003_PL_KEYS = ("pl03", "pl05", "pl1", "pl25", "pl5", "pl10")
 
 
-def _read_pms5003(
-    pms5003: PMS5003,
-    no_retries: bool = False,
-) -> Optional[PMS5003Result]:
-    while True:
+def _parse_pms5003(values: tuple[Any, ...]) -> PMS5003Result:
+    result = {
+        **dict(zip(_PMS5003_PM_KEYS, values[2:5])),
+        **dict(zip(_PMS5003_PL_KEYS, values[8:14])),
+    }
+    log.debug("PMS5003: %s", result)
+    return cast(PMS5003Result, result)
+
+
+class _PMS5003Reader:
+    """
+    Parses frames out of the PMS5003's serial port as the bytes arrive, so it
+    can be driven by the event loop rather than blocking a thread on read()
+    """
+
+    def __init__(self, pms5003: PMS5003) -> None:
+        # The library doesn't expose its serial port, but it's all we need
+        self._serial = pms5003._serial
+        # We only ever read what's already arrived, so never wait for more
+        self._serial.timeout = 0
+        self._buffer = bytearray()
+        self.got_frame = asyncio.Event()
+
+    def fileno(self) -> int:
+        fd: int = self._serial.fileno()
+        return fd
+
+    def on_readable(self) -> None:
         try:
-            pm_values = pms5003.read()
-            log.debug("PMS5003: %s", str(pm_values))
-            return {
-                "pm1": pm_values.pm_ug_per_m3(1),
-                "pm25": pm_values.pm_ug_per_m3(2.5),
-                "pm10": pm_values.pm_ug_per_m3(10),
-                "pl03": pm_values.pm_per_1l_air(0.3),
-                "pl05": pm_values.pm_per_1l_air(0.5),
-                "pl1": pm_values.pm_per_1l_air(1),
-                "pl25": pm_values.pm_per_1l_air(2.5),
-                "pl5": pm_values.pm_per_1l_air(5),
-                "pl10": pm_values.pm_per_1l_air(10),
-            }
-        except PMS5003ReadTimeoutError:
-            log.debug("Timed out :(")
-            continue
-        except (PMS5003SerialTimeoutError, PMS5003ChecksumError):
-            if no_retries:
+            self._buffer += self._serial.read(self._serial.in_waiting or 1)
+        except OSError:
+            # pyserial's SerialException is an OSError too. A broken port will
+            # probably keep looking readable, so stop listening to it rather
+            # than flooding the log, and let the timeout deal with the rest
+            log.exception("Error reading from the PMS5003, ignoring it from now on")
+            asyncio.get_running_loop().remove_reader(self.fileno())
+            _pms5003_data[0] = None
+            return
+
+        while True:
+            values = self._next_frame()
+            if values is None:
+                return
+            _pms5003_data[0] = _parse_pms5003(values)
+            self.got_frame.set()
+
+    def _next_frame(self) -> Optional[tuple[Any, ...]]:
+        buffer = self._buffer
+        while True:
+            start = buffer.find(PMS5003_SOF)
+            if start == -1:
+                # Hang on to the last byte in case it's half a start of frame
+                del buffer[:-1]
                 return None
-            log.exception("Fatal(ish) error reading from PMS5003")
-            pms5003.reset()
-            continue
+            del buffer[:start]
 
+            if len(buffer) < PMS5003_FRAME_SIZE:
+                return None
 
-async def _run_pms5003(loop: asyncio.AbstractEventLoop, pms5003: PMS5003) -> None:
-    global _pms5003_data
-    while True:
-        _pms5003_data = await loop.run_in_executor(None, _read_pms5003, pms5003, True)
+            values = _PMS5003_FRAME.unpack_from(buffer)
+            length: int = values[1]
+            checksum: int = values[-1]
+            if (
+                length == PMS5003_FRAME_SIZE - 4
+                and sum(buffer[: PMS5003_FRAME_SIZE - 2]) == checksum
+            ):
+                del buffer[:PMS5003_FRAME_SIZE]
+                return values
+
+            # Probably a false start, so look for the next one
+            log.debug(
+                "Discarding invalid PMS5003 frame %s", buffer[:PMS5003_FRAME_SIZE].hex()
+            )
+            del buffer[: len(PMS5003_SOF)]
+
+
+async def _run_pms5003(
+    loop: asyncio.AbstractEventLoop,
+    reader: _PMS5003Reader,
+) -> None:
+    loop.add_reader(reader.fileno(), reader.on_readable)
+    try:
+        while True:
+            reader.got_frame.clear()
+            try:
+                await asyncio.wait_for(reader.got_frame.wait(), PMS5003_TIMEOUT)
+            except asyncio.TimeoutError:
+                # Don't keep publishing the last reading from a silent sensor
+                log.debug("Timed out :(")
+                _pms5003_data[0] = None
+    finally:
+        loop.remove_reader(reader.fileno())
 
 
 async def setup_pms5003(loop: asyncio.AbstractEventLoop) -> asyncio.Task[None] | None:
     pms5003 = await loop.run_in_executor(None, lambda: PMS5003())
-    global _pms5003_data
-    _pms5003_data = await loop.run_in_executor(None, _read_pms5003, pms5003, True)
+    reader = _PMS5003Reader(pms5003)
+    task = loop.create_task(_run_pms5003(loop, reader))
 
-    if _pms5003_data is None:
+    try:
+        await asyncio.wait_for(reader.got_frame.wait(), PMS5003_TIMEOUT)
+    except asyncio.TimeoutError:
         log.info("No PMS5003 detected!")
+        task.cancel()
         return None
 
     log.info("PMS5003 found!")
 
-    return loop.create_task(_run_pms5003(loop, pms5003))
+    return task
 
 
 # Read values PMS5003 and return as dict
 def read_pms5003() -> Optional[PMS5003Result]:
-    return _pms5003_data
+    return _pms5003_data[0]
 
 
 # Get Raspberry Pi serial number to use as ID
+@functools.lru_cache(maxsize=1)
 def get_serial_number() -> str:
     with open("/proc/cpuinfo", "r") as f:
-        for line in f:
-            if line[0:6] == "Serial":
-                return line.split(":")[1].strip()
+        cpuinfo = f.read()
+
+    _, found, serial = cpuinfo.rpartition("\nSerial")
+    if not found:
+        return "0000000000000000"
+
+    return serial.partition("\n")[0].partition(":")[2].strip()
+
+
+NET_CLASS_PATH = "/sys/class/net"
+WIFI_INTERFACE = "wlan0"
 
-    return "0000000000000000"
+
+def _is_interface_up(interface: str) -> bool:
+    with open(os.path.join(NET_CLASS_PATH, interface, "operstate"), "r") as f:
+        return f.read().strip() == "up"
 
 
 # Check for Wi-Fi connection
 def check_wifi() -> bool:
-    return bool(subprocess.check_output(["hostname", "-I"]))
+    try:
+        return _is_interface_up(WIFI_INTERFACE)
+    except OSError:
+        pass
+
+    # No Wi-Fi adapter, so settle for any other kind of network connection
+    for interface in os.listdir(NET_CLASS_PATH):
+        if interface == "lo":
+            continue
+        try:
+            if _is_interface_up(interface):
+                return True
+        except OSError:
+            # Not everything in here is an interface (eg bonding_masters)
+            continue
+
+    return False
+
+
+# The sensors all sit at different addresses, so they can be read in parallel
+_sensor_pool = ThreadPoolExecutor(max_workers=3, thread_name_prefix="sensors")
 
 
 def get_current_data(ltr559: LTR559, bme280: BME280) -> dict[str, Any]:
+    _tick_cache.clear()
+    bme280_f = _sensor_pool.submit(read_bme280, bme280)
+    gas_f = _sensor_pool.submit(read_gas)
+    ltr559_f = _sensor_pool.submit(read_ltr559, ltr559)
     data: dict[str, Any] = {
-        **read_bme280(bme280),
-        **read_gas(),
-        "lux": read_ltr559(ltr559),
+        **bme280_f.result(),
+        **gas_f.result(),
+        "lux": ltr559_f.result(),
     }
+    return data
+
+
+def get_current_data_with_pms5003(ltr559: LTR559, bme280: BME280) -> dict[str, Any]:
+    data = get_current_data(ltr559, bme280)
     pms_data = read_pms5003()
     if pms_data:
         data.update(pms_data)
     return data
+
+
+@dataclass
+class SampleBuffer:
+    """
+    A fixed-size ring buffer of readings, stored as one array per value rather
+    than as a dict per reading. Once it's full the oldest readings get dropped.
+    """
+
+    capacity: int
+    columns: dict[str, array[float]] = field(default_factory=dict)
+    # Index of the oldest reading, which only moves once the buffer is full
+    start: int = 0
+    size: int = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, sample: dict[str, float]) -> None:
+        for key in sample.keys() - self.columns.keys():
+            self.columns[key] = array("d", [math.nan]) * self.capacity
+
+        index = (self.start + self.size) % self.capacity
+        for key, column in self.columns.items():
+            # Missing values (eg from the PMS5003 timing out) come out as null
+            column[index] = sample.get(key, math.nan)
+
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def as_dict(self) -> dict[str, list[float]]:
+        start, size = self.start, self.size
+        return {
+            key: (column[start:] + column[:start])[:size].tolist()
+            for key, column in self.columns.items()
+        }
+
+    def clear(self) -> None:
+        # The columns get overwritten in place, so there's no need to reset them
+        self.start = self.size = 0
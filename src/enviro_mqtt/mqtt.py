@@ -15,14 +15,19 @@
 """
 from __future__ import annotations
 
+import asyncio
 import logging
 from typing import Any, cast
 
-from gmqtt import Client as MQTTClient
+import gmqtt
 from typing_extensions import TypedDict
 
 log = logging.getLogger(__name__)
 
+# How long to wait between attempts to (re)connect to the broker
+RECONNECT_DELAY = 2
+MAX_RECONNECT_DELAY = 60
+
 
 class MQTTConf(TypedDict):
     broker: str
@@ -34,9 +39,11 @@ class MQTTConf(TypedDict):
     discovery_device: bool
     discovery_device_name: str
     topic_prefix: str
+    per_metric_topics: bool
     username: str | None
     password: str | None
     publish_interval: int
+    batch_size: int
     retain: bool
     qos: int
 
@@ -55,14 +62,28 @@ DEFAULT_MQTT_CONFIG: MQTTConf = {
     "discovery_device": True,
     "discovery_device_name": "Mystery Pi",
     "topic_prefix": "enviroplus",
+    "per_metric_topics": False,
     "username": None,
     "password": None,
     "publish_interval": 60,
+    "batch_size": 1,
     "retain": True,
     "qos": 0,
 }
 
 
+def _reconnect_delay(failures: int) -> int:
+    return int(min(RECONNECT_DELAY * 2**failures, MAX_RECONNECT_DELAY))
+
+
+class MQTTClient(gmqtt.Client):  # type: ignore[misc]
+    async def reconnect(self, delay: bool = False) -> None:
+        # gmqtt retries forever with a fixed delay, so back off exponentially
+        # instead of hammering a broker that's still restarting
+        self.reconnect_delay = _reconnect_delay(self.failed_connections)
+        await super().reconnect(delay)
+
+
 def on_connect(
     client: MQTTClient,
     flags: int,
@@ -85,6 +106,15 @@ def setup_mqtt_config(raw_config: MQTTConfInput) -> MQTTConf:
     if not mqtt_conf["broker"]:
         raise ValueError("Broker not configured!")
 
+    if mqtt_conf["batch_size"] < 1:
+        raise ValueError("Batch size must be at least 1!")
+
+    if mqtt_conf["discovery"] and mqtt_conf["batch_size"] > 1:
+        log.warning(
+            "Batched readings are published as lists of values, which the"
+            " discovery templates can't read!"
+        )
+
     return mqtt_conf
 
 
@@ -99,6 +129,16 @@ async def get_mqtt_client(mqtt_conf: MQTTConf) -> MQTTClient:
 
     log.info("Connecting to %s:%d", mqtt_conf["broker"], mqtt_conf["port"])
 
-    await client.connect(mqtt_conf["broker"], mqtt_conf["port"])
-
-    return client
+    # The broker might still be starting up, so keep trying rather than giving
+    # up and having to warm the sensors up all over again
+    failures = 0
+    while True:
+        try:
+            await client.connect(mqtt_conf["broker"], mqtt_conf["port"])
+        except OSError as e:
+            delay = _reconnect_delay(failures)
+            failures += 1
+            log.warning("Failed to connect (%s), retrying in %d seconds", e, delay)
+            await asyncio.sleep(delay)
+        else:
+            return client